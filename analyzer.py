@@ -3,13 +3,38 @@ analyzer.py - Envía hallazgos al LLM elegido para análisis y sugerencia de fix
 Usa litellm para soporte multi-provider (Ollama, OpenAI, Anthropic, etc).
 """
 
+import asyncio
+import hashlib
 import json
-from typing import List
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, List
 from scanner import Finding
+from cache import VerdictCache
+
+# orjson es opcional: más rápido para parsear respuestas batch. Su
+# JSONDecodeError hereda de json.JSONDecodeError, así que los except sirven igual.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 litellm = None
 
 
+def _http_client(async_client: bool = False):
+    """Cliente httpx que reusa conexiones keep-alive entre hallazgos en lugar de
+    pagar el handshake TCP/TLS en cada llamada. litellm solo usa
+    client_session/aclient_session en los providers OpenAI y Azure; Ollama y
+    Anthropic mantienen sus propios clientes."""
+    import httpx  # dependencia de litellm
+    limits = httpx.Limits(max_keepalive_connections=20, max_connections=100,
+                          keepalive_expiry=30.0)
+    client_class = httpx.AsyncClient if async_client else httpx.Client
+    return client_class(limits=limits, timeout=60.0)
+
+
 def _ensure_litellm():
     """Importa litellm bajo demanda para que --no-llm funcione sin la dependencia."""
     global litellm
@@ -17,54 +42,95 @@ def _ensure_litellm():
         try:
             import litellm as _litellm
             _litellm.suppress_debug_info = True
+            # Providers sin soporte para response_format lo ignoran en vez de fallar
+            _litellm.drop_params = True
+            # Cliente HTTP compartido para el camino sync (el async se crea por
+            # event loop, ver _run_with_http_client)
+            _litellm.client_session = _http_client()
             litellm = _litellm
         except ImportError:
             print("Error: litellm no esta instalado. Ejecuta: pip install litellm")
             print("       O usa --no-llm para ejecutar solo el scanner.")
             raise SystemExit(1)
 
-SYSTEM_PROMPT = """You are a senior code auditor. Your task is to determine if a code fragment can CRASH at runtime OR contains LOGIC ERRORS that produce incorrect behavior.
+# Prompt de sistema fijo. El detalle y los ejemplos de cada tipo de error van
+# en EXAMPLES_BY_CATEGORY: en Ollama solo se agregan al prompt del usuario
+# cuando el patrón detectado es de esa familia; en providers cloud van todos
+# en el system prompt (ver _FULL_PROMPT).
+CORE_PROMPT = """You are a senior code auditor. Your task is to determine if a code fragment can CRASH at runtime OR contains LOGIC ERRORS that produce incorrect behavior.
 
 You must analyze code in: C#, JavaScript, TypeScript, HTML, and Razor views.
 
-== RUNTIME CRASH SCENARIOS ==
+== WHAT TO LOOK FOR ==
 
-1. INDEX OUT OF BOUNDS: Accessing array[N] or list[N] when the collection may have fewer than N+1 elements.
-   Example: items[5].Value when items only has 3 elements. Split('"')[1] when the string has no quotes.
+Runtime crashes: index out of bounds, null reference, invalid cast, format/parse exception, division by zero, empty collection access (.First(), [0], .Single()), string operations on null values, disposed/closed resources, missing DOM elements or null Razor models, and unvalidated external data (database, API, SharePoint, config files, user input).
 
-2. NULL REFERENCE: Using .Property or .Method() on something that can be null.
-   Example: object.Name when object could be null. FirstOrDefault().Id without null check.
+Logic errors: parameters passed in the wrong order, wrong variable used, copy-paste errors, boolean logic errors, and off-by-one errors.
 
-3. INVALID CAST: Casting without checking type first.
-   Example: (FieldLookupValue)oListItem["Field"] when the field could be a different type or null.
+RESPONSE FORMAT - Reply ONLY with valid JSON, no markdown, no explanation outside the JSON:
+{
+  "is_bug": true,
+  "severity": "CRITICAL",
+  "crash_type": "INDEX_OUT_OF_BOUNDS",
+  "what_breaks": "items[5].Value crashes because items may have fewer than 6 elements",
+  "when_breaks": "When the SharePoint list returns fewer items than expected",
+  "original_code": "var x = items[5].Value;",
+  "fixed_code": "var x = items.Count > 5 ? items[5].Value : string.Empty;",
+  "explanation": "Brief explanation of the root cause"
+}
 
-4. FORMAT / PARSE EXCEPTION: Using int.Parse(), DateTime.Parse(), decimal.Parse() on user input or external data without TryParse.
-   Example: int.Parse(Request["id"]) when id could be "abc".
+CRASH_TYPE VALUES (use these exact strings):
+- Runtime crashes: INDEX_OUT_OF_BOUNDS, NULL_REFERENCE, INVALID_CAST, PARSE_EXCEPTION, DIVISION_BY_ZERO, EMPTY_COLLECTION, NULL_STRING_OP, DISPOSED_RESOURCE, UNVALIDATED_DATA
+- Logic errors: PARAMETER_ORDER_SWAP, WRONG_VARIABLE, COPY_PASTE_ERROR, BOOLEAN_LOGIC_ERROR, OFF_BY_ONE
+
+SEVERITY RULES:
+- CRITICAL: Will crash with normal production data OR logic error that produces clearly wrong results (swapped lat/long, wrong ID used)
+- HIGH: Will crash with real edge-case data OR logic error that affects calculations/data integrity
+- MEDIUM: Could crash with unusual but possible data OR logic error with limited impact
+- LOW: Unlikely to crash but technically unsafe, or minor logic inconsistency
+- FALSE_POSITIVE: Not a real bug, there IS protection the scanner missed (check carefully!)
 
-5. DIVISION BY ZERO: Dividing by a variable that could be zero.
-   Example: total / count when count comes from a query that could return 0.
+IMPORTANT:
+- The "fixed_code" field must contain ONLY valid code ready to copy-paste, NO explanatory text
+- The "original_code" field must contain the exact line(s) that need to change
+- If the code is actually safe (has a guard/check), set is_bug to false
+- Respond with ONLY the JSON object, nothing else"""
 
-6. EMPTY COLLECTION ACCESS: Calling .First(), [0], .Single() on a collection that could be empty.
+EXAMPLES_BY_CATEGORY = {
+    "index": """INDEX OUT OF BOUNDS: Accessing array[N] or list[N] when the collection may have fewer than N+1 elements.
+   Example: items[5].Value when items only has 3 elements. Split('"')[1] when the string has no quotes.
+
+EMPTY COLLECTION ACCESS: Calling .First(), [0], .Single() on a collection that could be empty.
    Example: list[0].Name when list comes from a database query that could return 0 rows.
 
-7. NULL STRING OPERATIONS: Calling .ToString(), .Split(), .Trim(), .ToLower() on a value that could be null.
+OFF-BY-ONE ERRORS: Incorrect loop bounds or index calculations.
+   Example: for (i = 0; i <= array.length; i++) // should be < not <=
+   Example: substring(0, length - 1) when full string was intended""",
+
+    "null": """NULL REFERENCE: Using .Property or .Method() on something that can be null.
+   Example: object.Name when object could be null. FirstOrDefault().Id without null check.
+
+INVALID CAST: Casting without checking type first.
+   Example: (FieldLookupValue)oListItem["Field"] when the field could be a different type or null.
+
+NULL STRING OPERATIONS: Calling .ToString(), .Split(), .Trim(), .ToLower() on a value that could be null.
    Example: oListItem["Field"].ToString() when the field value is null.
 
-8. DISPOSED / CLOSED RESOURCE: Using an object after it could be disposed or a connection after it could be closed.
+UNVALIDATED EXTERNAL DATA: Data from database, API, SharePoint, config files, or user input used directly without validation.
+   Example: ConfigurationManager.AppSettings["key"].ToString() when the key might not exist.""",
+
+    "parse": """FORMAT / PARSE EXCEPTION: Using int.Parse(), DateTime.Parse(), decimal.Parse() on user input or external data without TryParse.
+   Example: int.Parse(Request["id"]) when id could be "abc".
+   Example: JSON.parse() on a string that may not be valid JSON, without try/catch.""",
 
-9. JAVASCRIPT / TYPESCRIPT / RAZOR CRASHES:
+    "frontend": """JAVASCRIPT / TYPESCRIPT / RAZOR CRASHES:
    - document.getElementById("x").value when element might not exist
    - @Model.Property in Razor when Model could be null
    - querySelectorAll()[N] without checking length
    - JSON.parse() on invalid string
-   - TypeScript: accessing properties on possibly undefined values despite type assertions
+   - TypeScript: accessing properties on possibly undefined values despite type assertions""",
 
-10. UNVALIDATED EXTERNAL DATA: Data from database, API, SharePoint, config files, or user input used directly without validation.
-    Example: ConfigurationManager.AppSettings["key"].ToString() when the key might not exist.
-
-== LOGIC / SEMANTIC ERRORS ==
-
-11. PARAMETER ORDER SWAP: Arguments passed in wrong order due to similar types. This is a CRITICAL logic bug.
+    "logic": """PARAMETER ORDER SWAP: Arguments passed in wrong order due to similar types. This is a CRITICAL logic bug.
     Example: setCoordinates(longitude, longitude) instead of setCoordinates(longitude, latitude)
     Example: copyFile(destination, source) instead of copyFile(source, destination)
     Example: calculate(width, width) instead of calculate(width, height)
@@ -72,63 +138,124 @@ You must analyze code in: C#, JavaScript, TypeScript, HTML, and Razor views.
     Example: new Point(y, x) instead of new Point(x, y)
     LOOK FOR: Functions with 2+ parameters of the same type where the same variable is passed twice, or variables seem swapped based on naming conventions.
 
-12. WRONG VARIABLE USED: Using a similar-named variable instead of the correct one.
+WRONG VARIABLE USED: Using a similar-named variable instead of the correct one.
     Example: Using 'userId' instead of 'customerId' in a customer query
     Example: Using 'startDate' for both start and end parameters
     Example: Using 'request' object when 'response' was intended
     Example: Using loop variable from outer loop in inner loop
 
-13. COPY-PASTE ERRORS: Code that appears duplicated with incomplete modifications.
+COPY-PASTE ERRORS: Code that appears duplicated with incomplete modifications.
     Example: if (x > 0) { doX(); } else if (x > 0) { doY(); } // second condition should be different
     Example: setWidth(value); setWidth(value); // second should be setHeight
 
-14. BOOLEAN LOGIC ERRORS: Conditions that are always true/false or inverted.
+BOOLEAN LOGIC ERRORS: Conditions that are always true/false or inverted.
     Example: if (x > 5 && x < 3) // impossible condition
     Example: if (isValid == false) when if (!isValid) was intended but logic is inverted
-    Example: while (list.length > 0) { } // infinite loop if nothing removes from list
-
-15. OFF-BY-ONE ERRORS: Incorrect loop bounds or index calculations.
-    Example: for (i = 0; i <= array.length; i++) // should be < not <=
-    Example: substring(0, length - 1) when full string was intended
-
-RESPONSE FORMAT - Reply ONLY with valid JSON, no markdown, no explanation outside the JSON:
-{
-  "is_bug": true,
-  "severity": "CRITICAL",
-  "crash_type": "INDEX_OUT_OF_BOUNDS",
-  "what_breaks": "items[5].Value crashes because items may have fewer than 6 elements",
-  "when_breaks": "When the SharePoint list returns fewer items than expected",
-  "original_code": "var x = items[5].Value;",
-  "fixed_code": "var x = items.Count > 5 ? items[5].Value : string.Empty;",
-  "explanation": "Brief explanation of the root cause"
+    Example: while (list.length > 0) { } // infinite loop if nothing removes from list""",
 }
 
-CRASH_TYPE VALUES (use these exact strings):
-- Runtime crashes: INDEX_OUT_OF_BOUNDS, NULL_REFERENCE, INVALID_CAST, PARSE_EXCEPTION, DIVISION_BY_ZERO, EMPTY_COLLECTION, NULL_STRING_OP, DISPOSED_RESOURCE, UNVALIDATED_DATA
-- Logic errors: PARAMETER_ORDER_SWAP, WRONG_VARIABLE, COPY_PASTE_ERROR, BOOLEAN_LOGIC_ERROR, OFF_BY_ONE
-
-SEVERITY RULES:
-- CRITICAL: Will crash with normal production data OR logic error that produces clearly wrong results (swapped lat/long, wrong ID used)
-- HIGH: Will crash with real edge-case data OR logic error that affects calculations/data integrity
-- MEDIUM: Could crash with unusual but possible data OR logic error with limited impact
-- LOW: Unlikely to crash but technically unsafe, or minor logic inconsistency
-- FALSE_POSITIVE: Not a real bug, there IS protection the scanner missed (check carefully!)
-
-IMPORTANT:
-- The "fixed_code" field must contain ONLY valid code ready to copy-paste, NO explanatory text
-- The "original_code" field must contain the exact line(s) that need to change
-- If the code is actually safe (has a guard/check), set is_bug to false
-- Respond with ONLY the JSON object, nothing else"""
-
-
-def _build_user_prompt(finding: Finding) -> str:
-    """Construye el prompt con el contexto del hallazgo."""
-    context_before = "\n".join(finding.context_before) if finding.context_before else "(no prior context)"
-    context_after = "\n".join(finding.context_after) if finding.context_after else "(no following context)"
+# Familia de cada patrón del scanner (scanner.PATTERNS) para elegir ejemplos
+_PATTERN_CATEGORIES = {
+    "hardcoded_index_access": "index",
+    "split_with_index": "index",
+    "tolist_with_index": "index",
+    "collection_index_zero_no_check": "index",
+    "tables_index_access": "index",
+    "rows_index_access": "index",
+    "first_single_no_check": "index",
+    "first_or_default_deref": "null",
+    "tostring_on_nullable": "null",
+    "cast_without_as_or_is": "null",
+    "appsettings_direct_access": "null",
+    "parse_without_tryparse": "parse",
+    "js_json_parse_no_try": "parse",
+    "js_queryselector_index": "frontend",
+    "js_getelementbyid_direct": "frontend",
+    "razor_model_direct": "frontend",
+    "ts_non_null_assertion": "frontend",
+    "ts_type_assertion_any": "frontend",
+    "ts_optional_chain_missing": "frontend",
+    "duplicate_parameter_same_var": "logic",
+    "coord_param_order_suspect": "logic",
+    "copy_paste_duplicate_condition": "logic",
+}
 
-    return f"""Analyze this code for runtime crash risk:
 
-File: {finding.file_path}
+def _category_for(pattern_name: str) -> str:
+    return _PATTERN_CATEGORIES.get(pattern_name, "")
+
+
+def _uses_prompt_cache(model: str) -> bool:
+    """Providers cloud cachean el prefijo del prompt; Ollama no."""
+    return not model.startswith("ollama/")
+
+
+# Prompt de sistema para providers con prompt caching. Solo se cachean
+# prefijos de al menos 1024 tokens (OpenAI y Anthropic Sonnet/Opus; 2048 en
+# Haiku) y CORE_PROMPT solo ronda los 600: con todos los ejemplos el prefijo
+# supera ese mínimo y, una vez cacheado, cuesta menos que mandar los de cada
+# categoría sin cachear en el prompt del usuario.
+_FULL_PROMPT = CORE_PROMPT + "\n\n== CRASH SCENARIOS ==\n\n" + "\n\n".join(EXAMPLES_BY_CATEGORY.values())
+
+
+def _scenario_guide(findings: List[Finding], model: str) -> str:
+    """Detalle y ejemplos de los tipos de error relevantes para estos hallazgos.
+    Vacío si el modelo ya los recibe en el system prompt."""
+    if _uses_prompt_cache(model):
+        return ""
+    categories = []
+    for finding in findings:
+        category = _category_for(finding.pattern_name)
+        if category and category not in categories:
+            categories.append(category)
+    if not categories:
+        return ""
+    examples = "\n\n".join(EXAMPLES_BY_CATEGORY[c] for c in categories)
+    return f"Relevant crash scenarios:\n\n{examples}\n\n"
+
+
+_LINE_NUMBER_PREFIX = re.compile(r"^\d+: ")
+# Solo directivas y comentarios: `using (var r = ...)` / `using var r = ...;`
+# (C#) y los campos `#privados` (JS/TS) suelen declarar la variable señalada.
+_CONTEXT_NOISE = re.compile(
+    r"^\d+: \s*(using\s+(static\s+)?[\w.]+(\s*=\s*[\w.]+)?\s*;|import\s|//"
+    r"|#(region|endregion|if|elif|else|endif|define|undef|pragma|nullable|warning|error|line)\b)")
+_MAX_CONTEXT_LINE = 200
+
+
+def _compress_context(lines: List[str]) -> str:
+    """Reduce tokens del contexto sin perder el código relevante: descarta
+    imports y comentarios, trunca líneas largas y colapsa líneas en blanco."""
+    kept = []
+    blank_run = 0
+    for line in lines:
+        if _CONTEXT_NOISE.match(line):
+            continue
+        if not _LINE_NUMBER_PREFIX.sub("", line).strip():
+            blank_run += 1
+            if blank_run > 2:
+                continue
+        else:
+            blank_run = 0
+        line = line.rstrip()
+        if len(line) > _MAX_CONTEXT_LINE:
+            line = line[:_MAX_CONTEXT_LINE] + "…"
+        kept.append(line)
+    return "\n".join(kept)
+
+
+def _format_finding(finding: Finding, compress: bool = True) -> str:
+    """Bloque con la ubicación y el contexto de un hallazgo, común a ambos prompts."""
+    if compress:
+        context_before = _compress_context(finding.context_before)
+        context_after = _compress_context(finding.context_after)
+    else:
+        context_before = "\n".join(finding.context_before)
+        context_after = "\n".join(finding.context_after)
+    context_before = context_before or "(no prior context)"
+    context_after = context_after or "(no following context)"
+
+    return f"""File: {finding.file_path}
 Line: {finding.line_number}
 Detected pattern: {finding.pattern_name}
 
@@ -139,107 +266,668 @@ Context before:
 {finding.line_content}
 
 Context after:
-{context_after}
+{context_after}"""
+
+
+def _build_user_prompt(finding: Finding, model: str, compress: bool = True) -> str:
+    """Construye el prompt con el contexto del hallazgo."""
+    return f"""{_scenario_guide([finding], model)}Analyze this code for runtime crash risk:
+
+{_format_finding(finding, compress)}
 
 Can this code crash at runtime? If yes, what exact scenario causes the crash and what is the fix?"""
 
 
-def analyze_finding(finding: Finding, model: str, api_base: str = None) -> Finding:
-    """Analiza un hallazgo individual usando el LLM."""
-    _ensure_litellm()
+def _build_batched_user_prompt(findings_chunk: List[Finding], model: str,
+                               compress: bool = True) -> str:
+    """Construye un único prompt con varios hallazgos numerados."""
+    blocks = [f"### Finding {i}\n{_format_finding(f, compress)}" for i, f in enumerate(findings_chunk, 1)]
+    count = len(findings_chunk)
+    return f"""{_scenario_guide(findings_chunk, model)}Analyze these {count} independent code fragments for runtime crash risk:
+
+{(chr(10) * 2).join(blocks)}
+
+For each finding: can this code crash at runtime? If yes, what exact scenario causes the crash and what is the fix?
+
+Reply ONLY with a JSON object whose "verdicts" array has exactly {count} objects, one per finding. Each object uses the response format above plus an "index" field with the finding number:
+{{"verdicts": [{{"index": 1, "is_bug": true, "severity": "...", ...}}, {{"index": 2, ...}}]}}"""
+
+
+def _is_anthropic(model: str) -> bool:
+    return model.startswith(("claude", "anthropic/"))
+
+
+# Mensajes de sistema armados una sola vez: el prefijo queda byte a byte
+# idéntico en todos los requests (requisito del prompt caching). No mutarlos.
+_SYSTEM_MESSAGE = {"role": "system", "content": CORE_PROMPT}
+_FULL_SYSTEM_MESSAGE = {"role": "system", "content": _FULL_PROMPT}
+_CACHED_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [
+        {"type": "text", "text": _FULL_PROMPT, "cache_control": {"type": "ephemeral"}},
+    ],
+}
+
+
+def _system_message(model: str) -> dict:
+    """Mensaje de sistema; en Anthropic se marca como cacheable (prompt caching)."""
+    if _is_anthropic(model):
+        return _CACHED_SYSTEM_MESSAGE
+    if _uses_prompt_cache(model):
+        # OpenAI cachea automáticamente prefijos idénticos: el system prompt va siempre primero
+        return _FULL_SYSTEM_MESSAGE
+    return _SYSTEM_MESSAGE
+
+
+_VERDICT_PROPERTIES = {
+    "is_bug": {"type": "boolean"},
+    "severity": {"type": "string", "enum": ["CRITICAL", "HIGH", "MEDIUM", "LOW", "FALSE_POSITIVE"]},
+    "crash_type": {"type": "string"},
+    "what_breaks": {"type": "string"},
+    "when_breaks": {"type": "string"},
+    "original_code": {"type": "string"},
+    "fixed_code": {"type": "string"},
+    "explanation": {"type": "string"},
+}
+
+_VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": _VERDICT_PROPERTIES,
+    "required": list(_VERDICT_PROPERTIES),
+    "additionalProperties": False,
+}
+
+_BATCH_VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "verdicts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"index": {"type": "integer"}, **_VERDICT_PROPERTIES},
+                "required": ["index", *_VERDICT_PROPERTIES],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["verdicts"],
+    "additionalProperties": False,
+}
+
+
+def _response_format(model: str, batched: bool = False) -> dict:
+    """Fuerza JSON válido en el decode: schema estricto en providers cloud,
+    modo JSON en Ollama (que no valida schemas)."""
+    if model.startswith("ollama/"):
+        return {"type": "json_object"}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "verdicts" if batched else "verdict",
+            "schema": _BATCH_VERDICT_SCHEMA if batched else _VERDICT_SCHEMA,
+            "strict": True,
+        },
+    }
+
+
+# Un veredicto ocupa típicamente < 200 tokens; si la respuesta se corta por
+# longitud se reintenta una vez con el doble (ver _complete / _complete_async).
+MAX_TOKENS_PER_VERDICT = 350
+
+
+def _build_request(model: str, user_prompt: str, api_base: str = None,
+                   max_tokens: int = MAX_TOKENS_PER_VERDICT, batched: bool = False) -> dict:
+    """Arma los kwargs de la llamada a litellm."""
     kwargs = {
         "model": model,
         "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": _build_user_prompt(finding)},
+            _system_message(model),
+            {"role": "user", "content": user_prompt},
         ],
         "temperature": 0.1,
-        "max_tokens": 1000,
+        "max_tokens": max_tokens,
+        "response_format": _response_format(model, batched),
+        # litellm reintenta cualquier excepción (también auth o modelo inexistente);
+        # solo los RateLimitError (429) esperan con backoff exponencial
+        "num_retries": 3,
     }
 
     if api_base:
         kwargs["api_base"] = api_base
 
+    return kwargs
+
+
+def _apply_result(finding: Finding, result: dict) -> Finding:
+    """Completa los campos del hallazgo a partir del veredicto JSON del LLM."""
+    finding.severity = result.get("severity", "UNKNOWN")
+
+    # Construir análisis completo desde los campos nuevos
+    crash_type = result.get("crash_type", "")
+    what_breaks = result.get("what_breaks", "")
+    when_breaks = result.get("when_breaks", "")
+    explanation = result.get("explanation", "")
+
+    parts = []
+    if crash_type:
+        parts.append(f"[{crash_type}]")
+    if what_breaks:
+        parts.append(what_breaks)
+    elif explanation:
+        parts.append(explanation)
+    if when_breaks:
+        parts.append(f"Se rompe cuando: {when_breaks}")
+    finding.analysis = " ".join(parts) if parts else explanation
+
+    # Código original y fix separados
+    original = result.get("original_code", "")
+    fixed = result.get("fixed_code", "")
+    if original and fixed:
+        finding.suggested_fix = f"// ANTES:\n{original}\n\n// DESPUES:\n{fixed}"
+    elif fixed:
+        finding.suggested_fix = fixed
+    else:
+        finding.suggested_fix = result.get("suggested_fix", "")
+
+    if not result.get("is_bug", True):
+        finding.severity = "FALSE_POSITIVE"
+
+    return finding
+
+
+# UNKNOWN es lo que _apply_result asigna a un veredicto sin severidad
+_VERDICT_SEVERITIES = {*_VERDICT_PROPERTIES["severity"]["enum"], "UNKNOWN"}
+_VERDICT_TEXT_FIELDS = ("crash_type", "what_breaks", "when_breaks", "original_code",
+                        "fixed_code", "explanation", "suggested_fix")
+
+
+def _is_valid_verdict(result) -> bool:
+    """True si el veredicto tiene los tipos que espera _apply_result. Ollama no
+    valida el schema: un JSON bien formado puede traer listas, números o una
+    severidad inventada, y eso no debe tumbar la ejecución."""
+    if not isinstance(result, dict):
+        return False
+    severity = result.get("severity", "UNKNOWN")
+    if not isinstance(severity, str) or severity not in _VERDICT_SEVERITIES:
+        return False
+    if not isinstance(result.get("is_bug", True), bool):
+        return False
+    return all(isinstance(result.get(name, ""), str) for name in _VERDICT_TEXT_FIELDS)
+
+
+def _parse_verdict(content: str):
+    """Decodifica el veredicto JSON de un hallazgo; None si no es JSON válido o
+    sus campos no tienen el tipo esperado (ver _is_valid_verdict).
+    Con response_format el provider ya garantiza JSON: esto es el último recurso."""
     try:
-        response = litellm.completion(**kwargs)
-        content = response.choices[0].message.content.strip()
-
-        # Limpiar posible markdown wrapping
-        if content.startswith("```"):
-            content = content.split("\n", 1)[1] if "\n" in content else content
-            if content.endswith("```"):
-                content = content[:-3]
-            content = content.strip()
-
-        result = json.loads(content)
-
-        finding.severity = result.get("severity", "UNKNOWN")
-
-        # Construir análisis completo desde los campos nuevos
-        crash_type = result.get("crash_type", "")
-        what_breaks = result.get("what_breaks", "")
-        when_breaks = result.get("when_breaks", "")
-        explanation = result.get("explanation", "")
-
-        parts = []
-        if crash_type:
-            parts.append(f"[{crash_type}]")
-        if what_breaks:
-            parts.append(what_breaks)
-        elif explanation:
-            parts.append(explanation)
-        if when_breaks:
-            parts.append(f"Se rompe cuando: {when_breaks}")
-        finding.analysis = " ".join(parts) if parts else explanation
-
-        # Código original y fix separados
-        original = result.get("original_code", "")
-        fixed = result.get("fixed_code", "")
-        if original and fixed:
-            finding.suggested_fix = f"// ANTES:\n{original}\n\n// DESPUES:\n{fixed}"
-        elif fixed:
-            finding.suggested_fix = fixed
-        else:
-            finding.suggested_fix = result.get("suggested_fix", "")
+        result = _json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    return result if _is_valid_verdict(result) else None
 
-        if not result.get("is_bug", True):
-            finding.severity = "FALSE_POSITIVE"
 
+def _apply_unparsed(finding: Finding, content: str) -> Finding:
+    """Si el LLM no devolvió JSON válido, usar la respuesta raw."""
+    finding.severity = "NEEDS_REVIEW"
+    finding.analysis = content.strip() or "Error parsing LLM response"
+    finding.suggested_fix = ""
+    return finding
+
+
+def _parse_verdicts(content: str) -> Dict[int, dict]:
+    """Extrae los veredictos de una respuesta batch, indexados por número de hallazgo.
+
+    Si el JSON viene incompleto (p.ej. cortado por max_tokens) se rescatan los
+    objetos que sí se pueden decodificar; los faltantes se reintentan de a uno.
+    """
+    try:
+        items = _json.loads(content)
     except json.JSONDecodeError:
-        # Si el LLM no devolvió JSON válido, usar la respuesta raw
-        finding.severity = "NEEDS_REVIEW"
-        finding.analysis = content if 'content' in dir() else "Error parsing LLM response"
-        finding.suggested_fix = ""
+        items = []
+        decoder = json.JSONDecoder()
+        pos = content.find("{")
+        while pos != -1:
+            try:
+                obj, end = decoder.raw_decode(content, pos)
+            except json.JSONDecodeError:
+                pos = content.find("{", pos + 1)
+                continue
+            items.append(obj)
+            pos = content.find("{", end)
+
+    if isinstance(items, dict):
+        items = items.get("verdicts", [items])
+
+    # Los items con campos inválidos se descartan y se reintentan de a uno
+    verdicts = {}
+    for item in items:
+        if _is_valid_verdict(item) and isinstance(item.get("index"), int):
+            verdicts[item["index"]] = item
+    return verdicts
+
+
+def _is_model_not_found(error: Exception) -> bool:
+    """El modelo no existe en el provider (p.ej. no se hizo `ollama pull`).
+    litellm no siempre lo mapea a NotFoundError en Ollama, de ahí el texto."""
+    return isinstance(error, litellm.NotFoundError) or "not found" in str(error).lower()
+
+
+def _is_permanent_error(error: Exception) -> bool:
+    """Errores que no se arreglan reintentando ni cambiando de hallazgo (API key
+    inválida, sin permisos o modelo inexistente): cortan la ejecución en vez de
+    marcar todo ERROR."""
+    return (isinstance(error, (litellm.AuthenticationError, litellm.PermissionDeniedError))
+            or _is_model_not_found(error))
+
+
+def _apply_error(finding: Finding, error: Exception) -> Finding:
+    """Marca el hallazgo como no analizable por un error de comunicación."""
+    finding.severity = "ERROR"
+    finding.analysis = f"Error al comunicarse con el LLM: {str(error)}"
+    finding.suggested_fix = ""
+    return finding
+
+
+def _cache_key(finding: Finding, model: str) -> str:
+    """Hash del prompt de un hallazgo. Los números de línea del contexto se
+    excluyen para que mover código de lugar no invalide el veredicto."""
+    parts = [_FULL_PROMPT, model, finding.pattern_name]
+    parts.extend(_LINE_NUMBER_PREFIX.sub("", line) for line in finding.context_before)
+    parts.append(finding.line_content)
+    parts.extend(_LINE_NUMBER_PREFIX.sub("", line) for line in finding.context_after)
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _complete(request: dict) -> str:
+    """Llama al LLM (sin streaming) y devuelve el texto de la respuesta.
+    Si se cortó por max_tokens (finish_reason == "length") reintenta una vez
+    con el doble de tokens."""
+    response = litellm.completion(**request)
+    if response.choices[0].finish_reason == "length":
+        response = litellm.completion(**dict(request, max_tokens=request["max_tokens"] * 2))
+    return response.choices[0].message.content or ""
+
+
+async def _complete_async(request: dict, sem: asyncio.Semaphore = None) -> str:
+    """Versión async de _complete. Con `sem`, cada request ocupa un lugar del
+    semáforo mientras está en vuelo (límite de --concurrency)."""
+    if sem is None:
+        response = await litellm.acompletion(**request)
+        if response.choices[0].finish_reason == "length":
+            response = await litellm.acompletion(**dict(request, max_tokens=request["max_tokens"] * 2))
+        return response.choices[0].message.content or ""
+    async with sem:
+        return await _complete_async(request)
+
+
+def analyze_finding(finding: Finding, model: str, api_base: str = None,
+                    cache: VerdictCache = None, compress: bool = True) -> Finding:
+    """Analiza un hallazgo individual usando el LLM (o el cache, si ya fue analizado).
+
+    La respuesta se limita a MAX_TOKENS_PER_VERDICT tokens; si el LLM la corta
+    por longitud se reintenta una vez con el doble.
+    """
+    key = _cache_key(finding, model) if cache is not None else None
+    if key is not None:
+        cached = cache.get(key)
+        if _is_valid_verdict(cached):
+            return _apply_result(finding, cached)
+
+    _ensure_litellm()
+    try:
+        prompt = _build_user_prompt(finding, model, compress)
+        content = _complete(_build_request(model, prompt, api_base))
     except Exception as e:
-        finding.severity = "ERROR"
-        finding.analysis = f"Error al comunicarse con el LLM: {str(e)}"
-        finding.suggested_fix = ""
+        if _is_permanent_error(e):
+            raise
+        return _apply_error(finding, e)
+
+    result = _parse_verdict(content)
+    if result is None:
+        return _apply_unparsed(finding, content)
+    if key is not None:
+        cache[key] = result
+    return _apply_result(finding, result)
+
+
+# En el camino async, los veredictos crudos se registran en `verdicts` (por
+# id del hallazgo) y _run_all decide bajo qué clave persistirlos en el cache:
+# con triage, cada veredicto queda asociado al modelo que lo produjo.
+
+async def _analyze_finding_async(finding: Finding, model: str, api_base: str = None,
+                                 compress: bool = True, verdicts: dict = None,
+                                 sem: asyncio.Semaphore = None) -> Finding:
+    """Versión async de analyze_finding, para lanzar varios hallazgos en paralelo."""
+    try:
+        prompt = _build_user_prompt(finding, model, compress)
+        content = await _complete_async(_build_request(model, prompt, api_base), sem)
+    except Exception as e:
+        if _is_permanent_error(e):
+            raise
+        return _apply_error(finding, e)
+
+    result = _parse_verdict(content)
+    if result is None:
+        return _apply_unparsed(finding, content)
+    if verdicts is not None:
+        verdicts[id(finding)] = result
+    return _apply_result(finding, result)
+
+
+async def _analyze_chunk_async(chunk: List[Finding], model: str, api_base: str = None,
+                               compress: bool = True, verdicts: dict = None,
+                               sem: asyncio.Semaphore = None) -> List[Finding]:
+    """Analiza varios hallazgos en un único request; los que no vuelvan en la
+    respuesta se reintentan con un request individual."""
+    if len(chunk) == 1:
+        return [await _analyze_finding_async(chunk[0], model, api_base, compress, verdicts, sem)]
 
-    return finding
+    try:
+        request = _build_request(model, _build_batched_user_prompt(chunk, model, compress), api_base,
+                                 max_tokens=MAX_TOKENS_PER_VERDICT * len(chunk), batched=True)
+        results = _parse_verdicts(await _complete_async(request, sem))
+    except Exception as e:
+        if _is_permanent_error(e):
+            raise
+        results = {}
+
+    missing = []
+    for i, finding in enumerate(chunk, 1):
+        if i in results:
+            if verdicts is not None:
+                verdicts[id(finding)] = results[i]
+            _apply_result(finding, results[i])
+        else:
+            missing.append(finding)
+
+    # Los reintentos individuales se lanzan juntos, no uno detrás del otro
+    # (cada uno espera su lugar en `sem`)
+    await asyncio.gather(*(_analyze_finding_async(f, model, api_base, compress, verdicts, sem)
+                           for f in missing))
+    return chunk
+
+
+# Veredictos del modelo de triage que se re-analizan con el modelo principal
+_ESCALATE_SEVERITIES = {"MEDIUM", "NEEDS_REVIEW", "CRITICAL", "HIGH", "ERROR", "UNKNOWN"}
+
+
+async def _warm_prompt_cache(model: str, api_base: str = None, batched: bool = False):
+    """Request mínimo para que el provider cachee el system prompt antes de lanzar
+    los hallazgos en paralelo. Ollama no tiene prompt caching, se omite."""
+    if not _uses_prompt_cache(model):
+        return
+    try:
+        await litellm.acompletion(**_build_request(model, "ok", api_base, max_tokens=1, batched=batched))
+    except Exception:
+        pass  # Si falla, cada hallazgo reportará su propio error
+
+
+def prewarm_model(model: str, api_base: str = None, keep_alive: str = "30m") -> bool:
+    """Carga el modelo de Ollama en memoria antes del análisis para que el primer
+    hallazgo no pague el arranque en frío, y lo mantiene cargado `keep_alive`.
+    Devuelve False si el modelo no respondió (p.ej. no está instalado).
+
+    Va directo a /api/generate y no por litellm: litellm mete los kwargs que no
+    conoce dentro de "options", y Ollama solo respeta keep_alive en el nivel
+    superior del body. Un generate sin prompt solo carga el modelo.
+    """
+    import urllib.request
+    name = model.split("/", 1)[1] if model.startswith("ollama") else model
+    url = f"{(api_base or 'http://localhost:11434').rstrip('/')}/api/generate"
+    body = json.dumps({"model": name, "keep_alive": keep_alive}).encode("utf-8")
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    try:
+        # Cargar un modelo grande desde disco puede tardar
+        with urllib.request.urlopen(request, timeout=300) as response:
+            return response.status == 200
+    except Exception:
+        return False  # Si falla, cada hallazgo reportará su propio error
+
+
+def progress_write(message: str):
+    """print() que no rompe la barra de progreso del análisis; para pasar como
+    `log` a scanner.iter_findings cuando el escaneo corre junto al análisis."""
+    from tqdm import tqdm  # import diferido, igual que en _run_all
+    tqdm.write(message)
+
+
+def _copy_verdict(source: Finding, targets: List[Finding]):
+    """Replica el veredicto de un hallazgo en sus duplicados."""
+    for target in targets:
+        target.severity = source.severity
+        target.analysis = source.analysis
+        target.suggested_fix = source.suggested_fix
+
+
+# Ventana de micro-batching: un request sale apenas se juntan `batch_size`
+# hallazgos nuevos o pasa este tiempo desde el primero de la ventana.
+_BATCH_WINDOW_SECONDS = 0.25
+_END_OF_SCAN = object()
+# Lo encola una tarea que falló con un error permanente, para despertar al
+# despacho si está esperando hallazgos
+_ABORT = object()
+
+
+async def _run_all(findings: Iterable[Finding], model: str, api_base: str = None,
+                   concurrency: int = 10, batch_size: int = 5,
+                   cache: VerdictCache = None, compress: bool = True,
+                   triage_model: str = None) -> List[Finding]:
+    """Lanza los hallazgos contra el LLM en grupos de `batch_size` por request,
+    con a lo sumo `concurrency` requests en vuelo.
+
+    `findings` puede ser un generador (scanner.iter_findings): se consume en un
+    thread aparte y cada ventana se despacha sin esperar a que termine el
+    escaneo, así el tiempo total es max(escaneo, LLM) y no la suma.
+
+    Los hallazgos con el mismo código y contexto se agrupan: se analiza uno
+    solo por grupo y su veredicto se replica en el resto.
+
+    Con `triage_model`, cada grupo pasa primero por ese modelo chico y solo
+    los casos ambiguos o graves (ver _ESCALATE_SEVERITIES) se re-analizan
+    con `model`, conservando el veredicto de este último.
+    """
+    from tqdm import tqdm  # import diferido, igual que litellm (--no-llm no lo necesita)
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop_scan = threading.Event()
+    scan_errors: List[BaseException] = []
+
+    def _post(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            pass  # El loop ya cerró: la ejecución se cortó por un error
+
+    def _produce():
+        try:
+            for finding in findings:
+                if stop_scan.is_set():
+                    break
+                _post(finding)
+        except BaseException as e:
+            scan_errors.append(e)
+        finally:
+            if stop_scan.is_set() and hasattr(findings, "close"):
+                findings.close()  # Deja de escanear (y cancela lo pendiente del pool)
+            _post(_END_OF_SCAN)
+
+    # Thread daemon y no el executor del loop: si la ejecución se corta,
+    # asyncio.run no espera a que termine el escaneo en curso
+    threading.Thread(target=_produce, name="scanner", daemon=True).start()
+
+    received: List[Finding] = []
+    groups: Dict[str, List[Finding]] = {}
+    resolved: Dict[str, Finding] = {}
+    verdicts: Dict[int, dict] = {}
+    sem = asyncio.Semaphore(max(1, concurrency))
+    batch_size = max(1, batch_size)
+    progress = tqdm(total=0, desc="[Analyzer] Analizando", unit=" hallazgos", mininterval=0.1)
+    sent_count = 0
+    escalated_count = 0
+
+    def _resolve(key: str, result: Finding, verdict_model: str):
+        # El veredicto se cachea bajo el modelo que lo produjo: uno del triage
+        # no debe servirse como si fuera del modelo principal (--single-tier)
+        if cache is not None and id(result) in verdicts:
+            cache_key = key if verdict_model == model else _cache_key(result, verdict_model)
+            cache[cache_key] = verdicts[id(result)]
+        resolved[key] = result
+        members = groups[key]
+        _copy_verdict(result, members[1:])
+        progress.update(len(members))
+
+    async def _analyze(chunk: List[Finding]):
+        nonlocal escalated_count, triage_model
+        triage = triage_model
+        escalated = chunk
+        if triage is not None:
+            try:
+                await _analyze_chunk_async(chunk, triage, api_base, compress, verdicts, sem)
+            except Exception as e:
+                if not _is_model_not_found(e):
+                    raise
+                # Sin modelo de triage se sigue con un solo nivel
+                if triage_model is not None:
+                    tqdm.write(f"[Analyzer] Modelo de triage {triage_model} no disponible: "
+                               f"se analiza todo con {model}")
+                    triage_model = None
+            else:
+                escalated = [f for f in chunk if f.severity in _ESCALATE_SEVERITIES]
+                escalated_count += len(escalated)
+                for finding in escalated:
+                    verdicts.pop(id(finding), None)
+        if escalated:
+            await _analyze_chunk_async(escalated, model, api_base, compress, verdicts, sem)
+        escalated_ids = {id(f) for f in escalated}
+        for result in chunk:
+            _resolve(_cache_key(result, model), result,
+                     model if id(result) in escalated_ids else triage)
+
+    def _on_task_done(task: asyncio.Task):
+        # Las tareas solo fallan con errores permanentes (ver _is_permanent_error)
+        if not task.cancelled() and task.exception() is not None:
+            stop_scan.set()
+            queue.put_nowait(_ABORT)
+
+    tasks = []
+    window: List[Finding] = []
+    deadline = 0.0
+    scanning = True
+    while scanning:
+        timeout = max(0.0, deadline - loop.time()) if window else None
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            item = None
+
+        if stop_scan.is_set():
+            break  # Una tarea falló con un error permanente (ver _on_task_done)
+
+        if item is _END_OF_SCAN:
+            scanning = False
+        elif item is not None:
+            received.append(item)
+            progress.total = len(received)
+            key = _cache_key(item, model)
+            if key in groups:
+                # Duplicado: si su grupo ya tiene veredicto se copia, si no llegará con él
+                groups[key].append(item)
+                if key in resolved:
+                    _copy_verdict(resolved[key], [item])
+                    progress.update(1)
+            else:
+                groups[key] = [item]
+                cached = cache.get(key) if cache is not None else None
+                if cached is None and cache is not None and triage_model is not None:
+                    cached = cache.get(_cache_key(item, triage_model))
+                if _is_valid_verdict(cached):
+                    resolved[key] = _apply_result(item, cached)
+                    progress.update(1)
+                else:
+                    window.append(item)
+                    if len(window) == 1:
+                        deadline = loop.time() + _BATCH_WINDOW_SECONDS
+
+        if window and (not scanning or item is None or len(window) >= batch_size):
+            if not tasks and (scanning or len(window) > 1):
+                await _warm_prompt_cache(triage_model or model, api_base, batched=batch_size > 1)
+            task = asyncio.create_task(_analyze(window))
+            task.add_done_callback(_on_task_done)
+            tasks.append(task)
+            sent_count += len(window)
+            window = []
+
+    if tasks:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    failed = [t for t in tasks if t.done() and not t.cancelled() and t.exception() is not None]
+    if failed:
+        # Error permanente: no se escanea ni se envía nada más
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    progress.close()
+    if failed:
+        raise failed[0].exception()
+    if scan_errors:
+        raise scan_errors[0]
+
+    if triage_model is not None and sent_count:
+        print(f"\n[Analyzer] Triage con {triage_model}: {escalated_count}/{sent_count} "
+              f"escalados a {model}")
+
+    return received
+
+
+async def _run_with_http_client(*args) -> List[Finding]:
+    """Corre _run_all con un cliente HTTP async atado a este event loop y lo
+    cierra al terminar: un AsyncClient no sobrevive al loop que lo usó, y cada
+    analyze_findings corre su propio asyncio.run."""
+    litellm.aclient_session = _http_client(async_client=True)
+    try:
+        return await _run_all(*args)
+    finally:
+        client, litellm.aclient_session = litellm.aclient_session, None
+        await client.aclose()
 
 
-def analyze_findings(findings: List[Finding], model: str, api_base: str = None,
-                     batch_size: int = 5) -> List[Finding]:
-    """Analiza todos los hallazgos, mostrando progreso."""
-    total = len(findings)
-    analyzed = []
-
-    for i, finding in enumerate(findings):
-        print(f"[Analyzer] Analizando {i + 1}/{total}: {finding.file_path}:{finding.line_number} ({finding.pattern_name})")
-        result = analyze_finding(finding, model, api_base)
-        analyzed.append(result)
-
-        # Mostrar resultado inmediato
-        icon = {
-            "CRITICAL": "!!",
-            "HIGH": "! ",
-            "MEDIUM": "~ ",
-            "LOW": "  ",
-            "FALSE_POSITIVE": "OK",
-            "ERROR": "XX",
-            "NEEDS_REVIEW": "??",
-        }.get(result.severity, "??")
-        print(f"         [{icon}] {result.severity}: {result.analysis[:80]}")
+def _open_cache():
+    try:
+        return VerdictCache()
+    except (sqlite3.Error, OSError) as e:
+        print(f"[Analyzer] Cache deshabilitado: {e}")
+        return None
+
+
+def analyze_findings(findings: Iterable[Finding], model: str, api_base: str = None,
+                     batch_size: int = 5, concurrency: int = 10,
+                     use_cache: bool = True, compress: bool = True,
+                     triage_model: str = None) -> List[Finding]:
+    """Analiza todos los hallazgos en paralelo, mostrando progreso a medida que terminan.
+    `findings` puede ser una lista o un generador que se consume mientras se analiza.
+    Los veredictos se guardan en un cache persistente salvo que use_cache sea False;
+    con compress el contexto se recorta antes de enviarlo (ver _compress_context).
+    Si se indica triage_model, se usa como primer filtro antes de `model`."""
+    if triage_model == model:
+        triage_model = None
+    _ensure_litellm()
+    cache = _open_cache() if use_cache else None
+    try:
+        analyzed = asyncio.run(_run_with_http_client(findings, model, api_base, concurrency,
+                                                     batch_size, cache, compress, triage_model))
+    except (litellm.AuthenticationError, litellm.PermissionDeniedError) as e:
+        print(f"\nError: el LLM rechazo las credenciales: {e}")
+        print("       Verifica la API key del provider o usa --no-llm.")
+        raise SystemExit(1)
+    except Exception as e:
+        if not _is_model_not_found(e):
+            raise
+        print(f"\nError: el modelo {model} no existe en el provider: {e}")
+        print("       Verifica el nombre del modelo (en Ollama: ollama pull <modelo>) o usa --no-llm.")
+        raise SystemExit(1)
+    finally:
+        if cache is not None:
+            cache.close()
 
     # Resumen
     severities = {}
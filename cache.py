@@ -0,0 +1,52 @@
+"""
+cache.py - Cache persistente de veredictos del LLM.
+Evita re-enviar al LLM hallazgos cuyo código no cambió entre ejecuciones.
+"""
+
+import json
+import os
+import sqlite3
+from typing import Optional
+
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "agentAIQA", "verdicts.db")
+
+
+class VerdictCache:
+    """Veredictos JSON del LLM guardados en sqlite, indexados por hash del prompt."""
+
+    def __init__(self, path: str = CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # Autocommit: cada veredicto se persiste apenas llega, sin dejar una
+        # transacción abierta que bloquee a otra ejecución en paralelo. WAL deja
+        # leer mientras otro escribe; `timeout` espera un lock antes de fallar.
+        self._conn = sqlite3.connect(path, timeout=1.0, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, result TEXT NOT NULL)")
+
+    # Un error del cache (base bloqueada, disco lleno) nunca corta la auditoría:
+    # una lectura fallida cuenta como miss y una escritura fallida se pierde.
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            row = self._conn.execute("SELECT result FROM verdicts WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def __setitem__(self, key: str, result: dict):
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO verdicts (key, result) VALUES (?, ?)",
+                (key, json.dumps(result, ensure_ascii=False)),
+            )
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        self._conn.execute("DELETE FROM verdicts")
+
+    def close(self):
+        self._conn.close()
@@ -8,14 +8,17 @@ Modos de uso:
 """
 
 import argparse
+import functools
 import json
 import os
 import subprocess
 import sys
+from collections import deque
 
-from scanner import scan_directory
-from analyzer import analyze_findings
+from scanner import SKIP_DIRS, iter_findings, scan_directory
+from analyzer import analyze_findings, prewarm_model, progress_write
 from reporter import generate_report
+from cache import VerdictCache
 
 
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
@@ -23,18 +26,22 @@ CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.j
 PROVIDER_DEFAULTS = {
     "ollama": {
         "model": "ollama/deepcoder:14b",
+        "triage_model": "ollama/deepcoder:1.5b",
         "api_base": "http://localhost:11434",
     },
     "openai": {
         "model": "gpt-4o",
+        "triage_model": "gpt-4o-mini",
         "api_base": None,
     },
     "anthropic": {
         "model": "claude-sonnet-4-20250514",
+        "triage_model": "claude-3-5-haiku-20241022",
         "api_base": None,
     },
     "custom": {
         "model": None,
+        "triage_model": None,
         "api_base": None,
     },
 }
@@ -51,6 +58,18 @@ OLLAMA_SUGGESTED_MODELS = [
 
 # ─── Utilidades de consola ────────────────────────────────────────────
 
+# Ollama serializa los requests salvo que el *servidor* se lance con mas slots
+OLLAMA_MAX_PARALLEL = 8
+OLLAMA_PARALLEL_HINT = (f"Para analizar en paralelo: export OLLAMA_NUM_PARALLEL={OLLAMA_MAX_PARALLEL}"
+                        " && ollama serve")
+
+
+def ollama_runs_serially():
+    """True si OLLAMA_NUM_PARALLEL no esta configurado o vale 1. Es la variable
+    del servidor (`ollama serve`): este proceso solo puede sugerirla."""
+    return os.environ.get("OLLAMA_NUM_PARALLEL", "1") == "1"
+
+
 def clear_screen():
     os.system("cls" if os.name == "nt" else "clear")
 
@@ -107,6 +126,7 @@ def ask_yes_no(prompt, default=True):
 
 # ─── Deteccion de Ollama ─────────────────────────────────────────────
 
+@functools.lru_cache(maxsize=1)
 def detect_ollama_models():
     """Detecta modelos instalados en Ollama."""
     try:
@@ -127,27 +147,68 @@ def detect_ollama_models():
         return []
 
 
+@functools.lru_cache(maxsize=1)
 def is_ollama_running():
     """Verifica si Ollama esta corriendo."""
     try:
         import urllib.request
-        req = urllib.request.urlopen("http://localhost:11434/api/tags", timeout=3)
-        return req.status == 200
+        with urllib.request.urlopen("http://localhost:11434/api/tags", timeout=1) as req:
+            running = req.status == 200
     except Exception:
         return False
+    if running and os.environ.get("OLLAMA_NUM_PARALLEL") == "1":
+        print("  [Aviso] OLLAMA_NUM_PARALLEL=1: Ollama procesara los hallazgos de a uno.")
+        print(f"          {OLLAMA_PARALLEL_HINT}")
+    return running
+
+
+# ─── Deteccion de directorios con codigo ─────────────────────────────
+
+def _has_code(root, exts=(".cs", ".js"), cap=500):
+    """True si hay algun archivo con esas extensiones bajo root.
+
+    Recorre en anchura con os.scandir y corta en el primer archivo encontrado
+    o al visitar `cap` entradas, para no recorrer monorepos enteros. Omite los
+    mismos directorios que el scanner (SKIP_DIRS).
+    """
+    pending = deque([root])
+    visited = 0
+    while pending:
+        try:
+            with os.scandir(pending.popleft()) as it:
+                for entry in it:
+                    visited += 1
+                    if visited > cap:
+                        return False
+                    if entry.is_file() and entry.name.endswith(exts):
+                        return True
+                    if entry.is_dir(follow_symlinks=False) and entry.name not in SKIP_DIRS:
+                        pending.append(entry.path)
+        except OSError:
+            continue
+    return False
 
 
 # ─── Config file ─────────────────────────────────────────────────────
 
+@functools.lru_cache(maxsize=1)
+def _load_config_cached(mtime):
+    """Parsea config.json; el mtime como clave invalida el cache si el archivo cambia."""
+    try:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError):
+        return None
+
+
 def load_config():
     """Carga configuracion desde config.json."""
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return None
-    return None
+    try:
+        mtime = os.path.getmtime(CONFIG_FILE)
+    except OSError:
+        return None
+    config = _load_config_cached(mtime)
+    return dict(config) if config is not None else None
 
 
 def save_config(config):
@@ -189,7 +250,7 @@ def interactive_menu():
         for item in sorted(os.listdir(repo_root)):
             full = os.path.join(repo_root, item)
             if os.path.isdir(full) and not item.startswith(".") and item not in ("tools", "packages", "node_modules"):
-                if any(f.endswith(".cs") or f.endswith(".js") for _, _, files in os.walk(full) for f in files[:5]):
+                if _has_code(full):
                     suggested_dirs.append(full)
                     if len(suggested_dirs) >= 6:
                         break
@@ -275,6 +336,9 @@ def interactive_menu():
                     print(f"\n  Descargando {selected}... (esto puede tardar)\n")
                     subprocess.run(["ollama", "pull", selected])
 
+            if ollama_runs_serially():
+                print(f"\n  Tip: {OLLAMA_PARALLEL_HINT}")
+
         elif provider == "openai":
             print_option(1, "gpt-4o", "El mas capaz, mejor analisis")
             print_option(2, "gpt-4o-mini", "Mas rapido y barato, buen analisis")
@@ -383,6 +447,22 @@ Ejemplos:
     parser.add_argument("--output", "-o", default=None, help="Ruta del reporte markdown de salida")
     parser.add_argument("--extensions", "-e", nargs="+", default=None, help="Extensiones a escanear")
     parser.add_argument("--no-llm", action="store_true", help="Solo scanner, sin LLM")
+    parser.add_argument("--triage-model", default=None,
+                        help="Modelo rapido para el primer filtro (default: segun provider)")
+    parser.add_argument("--single-tier", action="store_true",
+                        help="Analizar todo con el modelo principal, sin triage previo")
+    parser.add_argument("--batch-size", type=int, default=5,
+                        help="Hallazgos enviados al LLM por request (default: 5)")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="Maximo de requests simultaneos al LLM (default: 10)")
+    parser.add_argument("--compress-context", dest="compress_context", action="store_true", default=True,
+                        help="Recortar imports, comentarios y lineas largas del contexto enviado al LLM (default)")
+    parser.add_argument("--no-compress-context", dest="compress_context", action="store_false",
+                        help="Enviar el contexto completo al LLM")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="No usar el cache de veredictos del LLM")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="Borrar el cache de veredictos antes de ejecutar")
     parser.add_argument("--interactive", "-i", action="store_true", help="Forzar menu interactivo")
     return parser.parse_args()
 
@@ -390,7 +470,7 @@ Ejemplos:
 def resolve_model_from_config(config):
     """Resuelve modelo y api_base desde un dict de configuracion."""
     provider = config.get("provider", "ollama")
-    model = config.get("model")
+    model = config.get("deep_model") or config.get("model")
     api_base = config.get("api_base")
 
     if model and "/" in model:
@@ -410,6 +490,31 @@ def resolve_model_from_config(config):
     return model, api_base
 
 
+def resolve_triage_model(config, model):
+    """Resuelve el modelo de triage (primer filtro rapido). None = un solo nivel."""
+    if config.get("single_tier"):
+        return None
+
+    provider = config.get("provider", "ollama")
+    triage_model = config.get("triage_model")
+
+    if not triage_model:
+        triage_model = PROVIDER_DEFAULTS.get(provider, {}).get("triage_model")
+        # El default de Ollama solo sirve si ya esta descargado: si no, cada
+        # hallazgo fallaria (con reintentos) antes de escalar al modelo principal
+        if provider == "ollama" and triage_model:
+            name = triage_model.split("/", 1)[1]
+            if name not in detect_ollama_models():
+                print(f"  [Info] Modelo de triage {name} no instalado: analisis de un solo nivel.")
+                print(f"         Para habilitarlo: ollama pull {name}")
+                return None
+
+    if provider == "ollama" and triage_model and not triage_model.startswith("ollama/"):
+        triage_model = f"ollama/{triage_model}"
+
+    return triage_model if triage_model != model else None
+
+
 # ─── Ejecucion principal ─────────────────────────────────────────────
 
 def run_audit(config):
@@ -426,32 +531,54 @@ def run_audit(config):
         print(f"  Provider:    {config.get('provider', 'ollama')}")
         print(f"  Modelo:      {config.get('model', 'auto')}")
 
-    # Paso 1: Escanear
-    print_header("PASO 1: ESCANEANDO CODIGO")
-    findings = scan_directory(scan_path, extensions)
-
-    if not findings:
-        print("  No se encontraron hallazgos. El codigo parece seguro.")
-        return
-
-    # Paso 2: Analizar con LLM
     if not no_llm:
+        # Pasos 1 y 2 en pipeline: el LLM analiza mientras el scanner sigue recorriendo
         model, api_base = resolve_model_from_config(config)
-        print_header("PASO 2: ANALIZANDO CON LLM")
+        triage_model = resolve_triage_model(config, model)
+        print_header("PASO 1 y 2: ESCANEANDO Y ANALIZANDO CON LLM")
         print(f"  Modelo: {model}")
+        if triage_model:
+            print(f"  Triage: {triage_model}")
         if api_base:
             print(f"  API Base: {api_base}")
-        print(f"  Hallazgos a analizar: {len(findings)}\n")
+        print()
 
-        findings = analyze_findings(findings, model, api_base)
+        if config.get("provider", "ollama") == "ollama":
+            if ollama_runs_serially():
+                print(f"  {OLLAMA_PARALLEL_HINT}\n")
+            # Carga los modelos antes del loop para no pagar el arranque en frío
+            if triage_model and triage_model.startswith("ollama/"):
+                if not prewarm_model(triage_model, api_base):
+                    print(f"  [Info] Modelo de triage {triage_model} no responde: "
+                          "analisis de un solo nivel.\n")
+                    triage_model = None
+            if model and model.startswith("ollama/"):
+                prewarm_model(model, api_base)
+
+        # El escaneo corre con la barra del analyzer activa: sus avisos van por tqdm.write
+        findings = analyze_findings(iter_findings(scan_path, extensions, log=progress_write),
+                                    model, api_base,
+                                    batch_size=config.get("batch_size", 5),
+                                    concurrency=config.get("concurrency", 10),
+                                    use_cache=config.get("use_cache", True),
+                                    compress=config.get("compress_context", True),
+                                    triage_model=triage_model)
         model_used = model
     else:
+        # Paso 1: Escanear
+        print_header("PASO 1: ESCANEANDO CODIGO")
+        findings = scan_directory(scan_path, extensions)
+
         print("\n  [Info] Modo sin LLM: omitiendo analisis inteligente")
         for f in findings:
             f.severity = "NEEDS_REVIEW"
             f.analysis = f"Patron detectado: {f.pattern_name}. Requiere revision manual."
         model_used = "ninguno (solo scanner)"
 
+    if not findings:
+        print("  No se encontraron hallazgos. El codigo parece seguro.")
+        return
+
     # Paso 3: Generar reporte
     print_header("PASO 3: GENERANDO REPORTE")
     generate_report(findings, output_path, scan_path, model_used)
@@ -463,6 +590,12 @@ def run_audit(config):
 def main():
     args = parse_args()
 
+    if args.clear_cache:
+        cache = VerdictCache()
+        cache.clear()
+        cache.close()
+        print(f"  Cache de veredictos borrado: {cache.path}")
+
     # Caso 1: Forzar interactivo
     if args.interactive:
         config = interactive_menu()
@@ -475,10 +608,16 @@ def main():
             "path": args.path,
             "provider": args.provider or "ollama",
             "model": args.model,
+            "triage_model": args.triage_model,
+            "single_tier": args.single_tier,
             "api_base": args.api_base,
             "extensions": args.extensions or [".cs", ".js", ".html", ".cshtml"],
             "output": args.output,
             "no_llm": args.no_llm,
+            "batch_size": args.batch_size,
+            "concurrency": args.concurrency,
+            "use_cache": not args.no_cache,
+            "compress_context": args.compress_context,
         }
         run_audit(config)
         return
@@ -5,134 +5,149 @@ reporter.py - Genera reporte markdown con los hallazgos analizados.
 import os
 from datetime import datetime
 from typing import List
-from collections import Counter
+from operator import attrgetter
 from scanner import Finding
 
 
+SEVERITY_ORDER = {"CRITICAL": 0, "HIGH": 1, "MEDIUM": 2, "LOW": 3, "NEEDS_REVIEW": 4, "ERROR": 5, "FALSE_POSITIVE": 6}
+
+
 def _severity_order(severity: str) -> int:
     """Ordena por severidad (mayor primero)."""
-    order = {"CRITICAL": 0, "HIGH": 1, "MEDIUM": 2, "LOW": 3, "NEEDS_REVIEW": 4, "ERROR": 5, "FALSE_POSITIVE": 6}
-    return order.get(severity, 99)
+    return SEVERITY_ORDER.get(severity, 99)
+
+
+_LANG_BY_EXT = {".cs": "csharp", ".js": "javascript", ".html": "html", ".cshtml": "html"}
 
 
 def _get_lang(file_path: str) -> str:
     """Detecta lenguaje para syntax highlight del markdown."""
     ext = os.path.splitext(file_path)[1].lower()
-    return {".cs": "csharp", ".js": "javascript", ".html": "html", ".cshtml": "html"}.get(ext, "")
+    return _LANG_BY_EXT.get(ext, "")
+
+
+def _format_finding(finding: Finding, index: int) -> str:
+    """Arma el bloque markdown de un hallazgo en un solo string (en vez de una
+    entrada por línea en el reporte)."""
+    lang = _get_lang(finding.file_path)
+    code = "\n".join([
+        *finding.context_before,
+        f">>> {finding.line_number}: {finding.line_content}  // <-- ERROR",
+        *finding.context_after,
+    ])
+    fix = (f"**Solucion propuesta:**\n```{lang}\n{finding.suggested_fix}\n```\n\n"
+           if finding.suggested_fix else "")
+    return (
+        f"### [{finding.severity}] Error #{index} - {finding.pattern_name}\n\n"
+        f"- **Archivo:** `{finding.file_path}`\n"
+        f"- **Linea:** {finding.line_number}\n"
+        f"- **Patron detectado:** {finding.pattern_name}\n\n"
+        f"**Codigo con error:**\n"
+        f"```{lang}\n{code}\n```\n\n"
+        f"**Problema:** {finding.analysis}\n\n"
+        f"{fix}---\n"
+    )
 
 
 def generate_report(findings: List[Finding], output_path: str, scanned_path: str,
                     model_used: str) -> str:
     """Genera el reporte markdown completo."""
 
-    # Filtrar false positives para el reporte principal
-    real_bugs = [f for f in findings if f.severity not in ("FALSE_POSITIVE", "ERROR")]
-    false_positives = [f for f in findings if f.severity == "FALSE_POSITIVE"]
-    errors = [f for f in findings if f.severity == "ERROR"]
+    # Separar false positives y errores del reporte principal en una sola pasada
+    real_bugs = []
+    false_positives = []
+    errors = []
+    for f in findings:
+        if f.severity == "FALSE_POSITIVE":
+            false_positives.append(f)
+        elif f.severity == "ERROR":
+            errors.append(f)
+        else:
+            real_bugs.append(f)
 
     # Ordenar por severidad
-    real_bugs.sort(key=lambda f: (_severity_order(f.severity), f.file_path, f.line_number))
-
-    # Contadores
-    severity_counts = Counter(f.severity for f in real_bugs)
-    file_counts = Counter(f.file_path for f in real_bugs)
+    # Dos pasadas estables: por ubicación (attrgetter, en C) y luego por severidad
+    real_bugs.sort(key=attrgetter("file_path", "line_number"))
+    real_bugs.sort(key=lambda f: SEVERITY_ORDER.get(f.severity, 99))
+
+    # Contadores y severidad máxima por archivo en una sola pasada. real_bugs ya
+    # está ordenado por severidad: la primera de cada archivo es la máxima, y en
+    # la tabla solo se destacan las que superan LOW.
+    low = SEVERITY_ORDER["LOW"]
+    severity_counts = {}
+    file_counts = {}
+    file_max_severity = {}
+    for f in real_bugs:
+        severity_counts[f.severity] = severity_counts.get(f.severity, 0) + 1
+        if f.file_path in file_counts:
+            file_counts[f.file_path] += 1
+        else:
+            file_counts[f.file_path] = 1
+            if _severity_order(f.severity) < low:
+                file_max_severity[f.file_path] = f.severity
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M")
 
-    lines = []
-    lines.append("# Reporte de Auditoria: Errores de Indices y Null Reference\n")
-    lines.append(f"**Fecha:** {now}  ")
-    lines.append(f"**Directorio analizado:** `{scanned_path}`  ")
-    lines.append(f"**Modelo LLM utilizado:** `{model_used}`  ")
-    lines.append(f"**Total de hallazgos analizados:** {len(findings)}  ")
-    lines.append(f"**Bugs confirmados:** {len(real_bugs)}  ")
-    lines.append(f"**Falsos positivos descartados:** {len(false_positives)}  ")
-    lines.append(f"**Errores de analisis:** {len(errors)}\n")
-
-    # Resumen ejecutivo
-    lines.append("## Resumen Ejecutivo\n")
-    lines.append("| Severidad | Cantidad |")
-    lines.append("|-----------|----------|")
-    for sev in ["CRITICAL", "HIGH", "MEDIUM", "LOW", "NEEDS_REVIEW"]:
-        count = severity_counts.get(sev, 0)
-        if count > 0:
-            lines.append(f"| {sev} | {count} |")
-    lines.append("")
-
-    # Errores detallados
-    if real_bugs:
-        lines.append("---\n")
-        lines.append("## Errores Encontrados\n")
-
-        for i, finding in enumerate(real_bugs, 1):
-            lang = _get_lang(finding.file_path)
-            rel_path = finding.file_path
-
-            lines.append(f"### [{finding.severity}] Error #{i} - {finding.pattern_name}\n")
-            lines.append(f"- **Archivo:** `{rel_path}`")
-            lines.append(f"- **Linea:** {finding.line_number}")
-            lines.append(f"- **Patron detectado:** {finding.pattern_name}\n")
-
-            lines.append("**Codigo con error:**")
-            lines.append(f"```{lang}")
-            # Contexto antes
-            for ctx in finding.context_before:
-                lines.append(ctx)
-            lines.append(f">>> {finding.line_number}: {finding.line_content}  // <-- ERROR")
-            for ctx in finding.context_after:
-                lines.append(ctx)
-            lines.append("```\n")
-
-            lines.append(f"**Problema:** {finding.analysis}\n")
-
-            if finding.suggested_fix:
-                lines.append("**Solucion propuesta:**")
-                lines.append(f"```{lang}")
-                lines.append(finding.suggested_fix)
-                lines.append("```\n")
-
-            lines.append("---\n")
-
-    # Tabla resumen por archivo
-    if file_counts:
-        lines.append("## Resumen por Archivo\n")
-        lines.append("| Archivo | Errores | Severidad maxima |")
-        lines.append("|---------|---------|-----------------|")
-
-        file_max_severity = {}
-        for f in real_bugs:
-            current = file_max_severity.get(f.file_path, "LOW")
-            if _severity_order(f.severity) < _severity_order(current):
-                file_max_severity[f.file_path] = f.severity
-
-        for file_path, count in file_counts.most_common():
-            short = os.path.basename(file_path)
-            max_sev = file_max_severity.get(file_path, "")
-            lines.append(f"| `{short}` | {count} | {max_sev} |")
-        lines.append("")
-
-    # Falsos positivos
-    if false_positives:
-        lines.append("## Falsos Positivos (descartados por el LLM)\n")
-        lines.append("Estos hallazgos fueron detectados por el scanner pero el LLM determino que no son bugs:\n")
-        for fp in false_positives:
-            lines.append(f"- `{os.path.basename(fp.file_path)}:{fp.line_number}` - {fp.analysis}")
-        lines.append("")
-
-    # Recomendaciones
-    lines.append("## Recomendaciones Generales\n")
-    lines.append("1. **Siempre validar bounds antes de acceder por indice:** Usar `.Count > N` o `.Length > N` antes de `collection[N]`")
-    lines.append("2. **Verificar null despues de FirstOrDefault():** El resultado puede ser null si la coleccion esta vacia o no hay match")
-    lines.append("3. **Verificar resultado de Split():** `string.Split()` puede retornar menos elementos de los esperados")
-    lines.append("4. **Usar operador null-conditional:** Preferir `collection?.FirstOrDefault()?.Property` cuando sea apropiado")
-    lines.append("5. **Validar colecciones de SharePoint:** Las listas de SharePoint pueden estar vacias o tener campos null")
-    lines.append("6. **Validar configuraciones:** Los valores de `ConfigurationManager.AppSettings` pueden no tener el formato esperado")
-    lines.append("")
-
-    content = "\n".join(lines)
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(content)
+    # Se escribe por secciones directo al archivo, sin armar el reporte completo
+    # en memoria
+    with open(output_path, "w", encoding="utf-8") as out:
+        out.write("# Reporte de Auditoria: Errores de Indices y Null Reference\n\n")
+        out.write(f"**Fecha:** {now}  \n")
+        out.write(f"**Directorio analizado:** `{scanned_path}`  \n")
+        out.write(f"**Modelo LLM utilizado:** `{model_used}`  \n")
+        out.write(f"**Total de hallazgos analizados:** {len(findings)}  \n")
+        out.write(f"**Bugs confirmados:** {len(real_bugs)}  \n")
+        out.write(f"**Falsos positivos descartados:** {len(false_positives)}  \n")
+        out.write(f"**Errores de analisis:** {len(errors)}\n\n")
+
+        # Resumen ejecutivo
+        out.write("## Resumen Ejecutivo\n\n")
+        out.write("| Severidad | Cantidad |\n")
+        out.write("|-----------|----------|\n")
+        for sev in ["CRITICAL", "HIGH", "MEDIUM", "LOW", "NEEDS_REVIEW"]:
+            count = severity_counts.get(sev, 0)
+            if count > 0:
+                out.write(f"| {sev} | {count} |\n")
+        out.write("\n")
+
+        # Errores detallados
+        if real_bugs:
+            out.write("---\n\n")
+            out.write("## Errores Encontrados\n\n")
+
+            for i, finding in enumerate(real_bugs, 1):
+                out.write(_format_finding(finding, i))
+                out.write("\n")
+
+        # Tabla resumen por archivo
+        if file_counts:
+            out.write("## Resumen por Archivo\n\n")
+            out.write("| Archivo | Errores | Severidad maxima |\n")
+            out.write("|---------|---------|-----------------|\n")
+
+            # Más errores primero; sorted es estable y respeta el orden de aparición
+            for file_path, count in sorted(file_counts.items(), key=lambda kv: -kv[1]):
+                short = os.path.basename(file_path)
+                max_sev = file_max_severity.get(file_path, "")
+                out.write(f"| `{short}` | {count} | {max_sev} |\n")
+            out.write("\n")
+
+        # Falsos positivos
+        if false_positives:
+            out.write("## Falsos Positivos (descartados por el LLM)\n\n")
+            out.write("Estos hallazgos fueron detectados por el scanner pero el LLM determino que no son bugs:\n\n")
+            for fp in false_positives:
+                out.write(f"- `{os.path.basename(fp.file_path)}:{fp.line_number}` - {fp.analysis}\n")
+            out.write("\n")
+
+        # Recomendaciones
+        out.write("## Recomendaciones Generales\n\n")
+        out.write("1. **Siempre validar bounds antes de acceder por indice:** Usar `.Count > N` o `.Length > N` antes de `collection[N]`\n")
+        out.write("2. **Verificar null despues de FirstOrDefault():** El resultado puede ser null si la coleccion esta vacia o no hay match\n")
+        out.write("3. **Verificar resultado de Split():** `string.Split()` puede retornar menos elementos de los esperados\n")
+        out.write("4. **Usar operador null-conditional:** Preferir `collection?.FirstOrDefault()?.Property` cuando sea apropiado\n")
+        out.write("5. **Validar colecciones de SharePoint:** Las listas de SharePoint pueden estar vacias o tener campos null\n")
+        out.write("6. **Validar configuraciones:** Los valores de `ConfigurationManager.AppSettings` pueden no tener el formato esperado\n")
 
     print(f"\n[Reporter] Reporte generado en: {output_path}")
     print(f"[Reporter] {len(real_bugs)} bugs documentados, {len(false_positives)} falsos positivos descartados")
@@ -3,12 +3,36 @@ scanner.py - Escanea archivos de código buscando patrones peligrosos
 de acceso a índices sin validación de bounds.
 """
 
+import multiprocessing
 import os
 import re
-from dataclasses import dataclass, field
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field, fields
+from itertools import chain, islice
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
 
+
+def _with_slots(cls):
+    """Equivalente a @dataclass(slots=True), que requiere Python 3.10+: recrea la
+    clase con __slots__ para que cada instancia no cargue su propio __dict__."""
+    names = tuple(f.name for f in fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in names and key not in ("__dict__", "__weakref__")}
+    namespace["__slots__"] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+# Líneas de contexto que se muestran antes y después de cada hallazgo
+CONTEXT_WINDOW = 5
+
+
+@_with_slots
 @dataclass
 class Finding:
     """Representa un hallazgo de código potencialmente peligroso."""
@@ -16,12 +40,26 @@ class Finding:
     line_number: int
     line_content: str
     pattern_name: str
-    context_before: List[str] = field(default_factory=list)
-    context_after: List[str] = field(default_factory=list)
+    # Todas las líneas del archivo, compartidas por sus hallazgos: el contexto
+    # se arma a pedido en vez de copiar la ventana en cada uno
+    file_lines: Tuple[str, ...] = field(default=(), repr=False, compare=False)
     severity: str = ""
     analysis: str = ""
     suggested_fix: str = ""
 
+    @property
+    def context_before(self) -> List[str]:
+        """Líneas previas al hallazgo, numeradas ("N: texto")."""
+        start = max(0, self.line_number - 1 - CONTEXT_WINDOW)
+        lines = self.file_lines[start:self.line_number - 1]
+        return [f"{n}: {line}" for n, line in enumerate(lines, start + 1)]
+
+    @property
+    def context_after(self) -> List[str]:
+        """Líneas posteriores al hallazgo, numeradas ("N: texto")."""
+        lines = self.file_lines[self.line_number:self.line_number + CONTEXT_WINDOW]
+        return [f"{n}: {line}" for n, line in enumerate(lines, self.line_number + 1)]
+
 
 # Patrones de búsqueda con sus descripciones
 PATTERNS = [
@@ -188,6 +226,91 @@ PATTERNS = [
     },
 ]
 
+
+def _compile_by_ext(as_bytes: bool = False) -> Dict[str, List[Tuple[dict, "re.Pattern"]]]:
+    """Agrupa los patrones por extensión, ya compilados y en el orden de PATTERNS."""
+    compiled = {}
+    for pd in PATTERNS:
+        source = pd["regex"].encode() if as_bytes else pd["regex"]
+        regex = re.compile(source, re.IGNORECASE if pd.get("case_insensitive") else 0)
+        for ext in pd["extensions"]:
+            compiled.setdefault(ext, []).append((pd, regex))
+    return compiled
+
+
+# Se compila una sola vez al importar, no en cada archivo. Los archivos ASCII
+# (la mayoría) se escanean en bytes sin decodificar, donde el motor de regex es
+# más rápido. \w e IGNORECASE dan lo mismo que en str, pero \s en str también
+# acepta \x1c-\x1f: los archivos con esos bytes van por str (ver scan_file).
+COMPILED_BY_EXT = _compile_by_ext()
+COMPILED_BYTES_BY_EXT = _compile_by_ext(as_bytes=True)
+
+
+# Posición de cada patrón de PATTERNS dentro de COMPILED_BY_EXT[ext]
+_POSITION_BY_EXT = {
+    ext: {PATTERNS.index(pd): i for i, (pd, _) in enumerate(compiled)}
+    for ext, compiled in COMPILED_BY_EXT.items()
+}
+# Compilar la base de Hyperscan cuesta por proceso (cada worker del pool
+# compila la suya): ~0.1 s la de archivos ASCII y ~1.2 s la Unicode (UTF8+UCP).
+# Solo se compila cuando el proceso ya escaneó esta cantidad de archivos de
+# ese tipo; antes se escanea sin prefiltro, así un árbol chico no la paga.
+HYPERSCAN_MIN_FILES = {False: 64, True: 512}
+_hyperscan_dbs = {}
+_files_by_kind = {False: 0, True: 0}
+
+
+def _hyperscan_database(unicode: bool) -> "hyperscan.Database":
+    """Compila, una vez por proceso, una base de Hyperscan con todos los patrones.
+
+    HS_FLAG_PREFILTER acepta lo que Hyperscan no soporta (backreferences, \\b con
+    Unicode) aproximándolo por un superconjunto. Con `unicode`, UTF8/UCP
+    mantienen el \\w/\\d/\\s de `re`; sin él son solo ASCII, que alcanza para
+    archivos ASCII y compila diez veces más rápido.
+    """
+    db = _hyperscan_dbs.get(unicode)
+    if db is None:
+        base_flags = hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_PREFILTER
+        if unicode:
+            base_flags |= hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[pd["regex"].encode() for pd in PATTERNS],
+            ids=list(range(len(PATTERNS))),
+            elements=len(PATTERNS),
+            flags=[base_flags | (hyperscan.HS_FLAG_CASELESS if pd.get("case_insensitive") else 0)
+                   for pd in PATTERNS],
+        )
+        _hyperscan_dbs[unicode] = db
+    return db
+
+
+def _candidate_patterns(ext: str, data: bytes, unicode: bool) -> Optional[List[int]]:
+    """Posiciones (en COMPILED_BY_EXT[ext]) de los patrones que aparecen en el archivo.
+
+    Hyperscan (opcional) busca todos los patrones de una sola pasada sobre el
+    texto completo, que es un superconjunto de buscar línea por línea: solo se
+    descartan patrones que seguro no coinciden. Devuelve None sin Hyperscan o
+    mientras no se hayan escaneado HYPERSCAN_MIN_FILES archivos de este tipo.
+    `data` tiene que ser UTF-8 válido con `unicode`, y ASCII sin él.
+    """
+    if hyperscan is None:
+        return None
+    if _files_by_kind[unicode] < HYPERSCAN_MIN_FILES[unicode]:
+        _files_by_kind[unicode] += 1
+        return None
+    positions = _POSITION_BY_EXT[ext]
+    hits = set()
+
+    def on_match(pattern_id, start, end, flags, context):
+        position = positions.get(pattern_id)
+        if position is not None:
+            hits.add(position)
+
+    _hyperscan_database(unicode).scan(data, match_event_handler=on_match)
+    return sorted(hits)
+
+
 # Patrones que indican que YA existe una verificación de bounds
 GUARD_PATTERNS = [
     r'\.Count\s*[>]=?\s*\d+',
@@ -211,49 +334,88 @@ GUARD_PATTERNS = [
 ]
 
 
+# Todos los guards en una sola regex: una búsqueda por candidato en vez de una
+# por guard. Se busca sobre las líneas unidas porque un guard puede cruzarlas.
+_GUARD_RE = re.compile("|".join(f"(?:{guard})" for guard in GUARD_PATTERNS))
+
+
 def _has_guard(context_lines: List[str], current_line: str) -> bool:
-    """Verifica si en las líneas de contexto previas hay una validación de bounds."""
-    all_text = " ".join(context_lines) + " " + current_line
-    for guard in GUARD_PATTERNS:
-        if re.search(guard, all_text):
-            return True
-    return False
+    """Verifica si en las líneas de contexto previas hay una validación de bounds.
+
+    Recibe las líneas crudas (con su salto de línea): los guards solo usan \\s
+    entre tokens, así que no hace falta limpiarlas antes de unirlas.
+    """
+    all_text = "".join(context_lines) + " " + current_line
+    return _GUARD_RE.search(all_text) is not None
+
+
+_COMMENT_PREFIXES = ("//", "/*", "*")
+_COMMENT_PREFIXES_BYTES = (b"//", b"/*", b"*")
+# Lo que str.strip() considera espacio dentro de ASCII (bytes.strip() no incluye \x1c-\x1f)
+_WHITESPACE_BYTES = b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
 
 
-def _get_context(lines: List[str], line_idx: int, window: int = 5) -> Tuple[List[str], List[str]]:
-    """Obtiene líneas de contexto antes y después del hallazgo."""
-    start = max(0, line_idx - window)
-    end = min(len(lines), line_idx + window + 1)
-    before = [f"{start + i + 1}: {lines[start + i]}" for i in range(line_idx - start)]
-    after = [f"{line_idx + 2 + i}: {lines[line_idx + 1 + i]}" for i in range(end - line_idx - 1)]
-    return before, after
+# Archivos más grandes suelen ser bundles minificados o código generado: el
+# regex se lleva casi todo el tiempo del escaneo y no aportan hallazgos útiles
+MAX_FILE_SIZE = 2 * 1024 * 1024
+_BINARY_PROBE_SIZE = 4096
+# Espacios para el \s de `re` en str, pero no para el de bytes ni el de Hyperscan
+_STR_ONLY_SPACE = re.compile(rb"[\x1c-\x1f]")
 
 
 def scan_file(file_path: str) -> List[Finding]:
     """Escanea un archivo individual buscando patrones peligrosos."""
     findings = []
     ext = os.path.splitext(file_path)[1].lower()
+    compiled = COMPILED_BY_EXT.get(ext)
+    if compiled is None:
+        return findings
 
     try:
-        with open(file_path, "r", encoding="utf-8-sig", errors="replace") as f:
-            lines = f.readlines()
+        # Al recorrer un directorio, _walk ya avisó de este archivo
+        if os.path.getsize(file_path) > MAX_FILE_SIZE:
+            return findings
+        with open(file_path, "rb") as f:
+            head = f.read(_BINARY_PROBE_SIZE)
+            # Un byte nulo al principio delata un binario (o UTF-16), no código
+            if b"\x00" in head:
+                return findings
+            data = head + f.read()
     except (OSError, IOError):
         return findings
 
-    for pattern_def in PATTERNS:
-        if ext not in pattern_def["extensions"]:
-            continue
+    if data[:3] == b"\xef\xbb\xbf":
+        data = data[3:]
+    # Mismos saltos de línea que el modo texto (universal newlines)
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
 
-        flags = re.IGNORECASE if pattern_def.get("case_insensitive") else 0
-        regex = re.compile(pattern_def["regex"], flags)
+    plain = _STR_ONLY_SPACE.search(data) is None
+    if plain and data.isascii():
+        lines = data.splitlines(keepends=True)
+        comment_prefixes, whitespace = _COMMENT_PREFIXES_BYTES, _WHITESPACE_BYTES
+        compiled = COMPILED_BYTES_BY_EXT[ext]
+    else:
+        text = data.decode("utf-8", errors="replace")
+        data = text.encode("utf-8")
+        lines = text.split("\n")
+        lines = [line + "\n" for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+        comment_prefixes, whitespace = _COMMENT_PREFIXES, None
 
-        for i, line in enumerate(lines):
-            stripped = line.strip()
+    candidates = _candidate_patterns(ext, data, unicode=whitespace is None) if plain else None
+    if candidates is not None:
+        compiled = [compiled[c] for c in candidates]
+        if not compiled:
+            return findings
 
-            # Ignorar comentarios
-            if stripped.startswith("//") or stripped.startswith("/*") or stripped.startswith("*"):
-                continue
+    text_lines = None  # se decodifica solo si el archivo tiene algún hallazgo
 
+    for i, line in enumerate(lines):
+        # Ignorar comentarios
+        if line.lstrip(whitespace).startswith(comment_prefixes):
+            continue
+
+        for pattern_def, regex in compiled:
             match = regex.search(line)
             if not match:
                 continue
@@ -264,52 +426,129 @@ def scan_file(file_path: str) -> List[Finding]:
                 if idx_value < pattern_def["min_index"]:
                     continue
 
+            if text_lines is None:
+                text_lines = tuple(l.decode("ascii") for l in lines) if whitespace else tuple(lines)
+            stripped = text_lines[i].strip()
+
             # Verificar si ya hay un guard en las líneas anteriores
             context_start = max(0, i - 5)
-            context_lines = [lines[j].strip() for j in range(context_start, i)]
-
-            if _has_guard(context_lines, stripped):
+            if _has_guard(text_lines[context_start:i], stripped):
                 continue
 
-            before, after = _get_context(lines, i)
-
             finding = Finding(
                 file_path=file_path,
                 line_number=i + 1,
                 line_content=stripped,
                 pattern_name=pattern_def["name"],
-                context_before=before,
-                context_after=after,
+                file_lines=text_lines,
             )
             findings.append(finding)
 
     return findings
 
 
-def scan_directory(root_path: str, extensions: List[str] = None) -> List[Finding]:
-    """Escanea recursivamente un directorio buscando patrones peligrosos."""
+# Por debajo de esta cantidad de archivos no compensa levantar procesos: cada
+# worker (spawn) tarda ~0.15 s en arrancar y en serie se escanean ~3000
+# archivos por segundo, así que con menos de ~1000 el pool sale más lento.
+PARALLEL_MIN_FILES = 1000
+PARALLEL_CHUNKSIZE = 32
+
+
+def _too_big(entry: os.DirEntry) -> bool:
+    try:
+        return entry.stat().st_size > MAX_FILE_SIZE
+    except OSError:
+        return False  # p.ej. symlink roto: scan_file lo descarta al abrirlo
+
+
+# Directorios comunes no relevantes (dependencias, builds, metadatos)
+SKIP_DIRS = {"bin", "obj", "node_modules", ".git", ".vs", "packages", "debug", "release"}
+
+
+def _walk(root_path: str, extensions: List[str],
+          log: Callable[[str], None] = print) -> Iterator[str]:
+    """Recorre el directorio con os.scandir entregando los archivos a escanear.
+
+    A diferencia de os.walk, usa el tipo cacheado de cada DirEntry en lugar de
+    hacer un stat por entrada (solo se hace stat de los archivos a escanear,
+    para avisar de los que scan_file omite por superar MAX_FILE_SIZE).
+    """
+    wanted = set(extensions)
+    stack = [root_path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    # Igual que os.walk: los symlinks a directorios no se recorren
+                    if entry.is_dir():
+                        if entry.name not in SKIP_DIRS and not entry.is_symlink():
+                            stack.append(entry.path)
+                    # splitext, no endswith: un dotfile como ".cs" no tiene extensión
+                    elif os.path.splitext(entry.name)[1].lower() in wanted:
+                        # Se entrega igual (scan_file lo descarta): solo se avisa acá
+                        if _too_big(entry):
+                            log(f"[Scanner] Omitido (mas de {MAX_FILE_SIZE // (1024 * 1024)} MB): "
+                                f"{entry.path}")
+                        yield entry.path
+        except OSError:
+            continue
+
+
+def iter_findings(root_path: str, extensions: List[str] = None,
+                  log: Callable[[str], None] = print) -> Iterator[Finding]:
+    """Escanea recursivamente un directorio, entregando los hallazgos a medida que aparecen.
+
+    Con muchos archivos el escaneo (puro CPU) se reparte en un pool de procesos;
+    los resultados se entregan en el mismo orden que el recorrido secuencial.
+    El pool usa spawn: un script que llame a esta función (o a scan_directory)
+    tiene que hacerlo bajo `if __name__ == "__main__":`. Sin eso los workers no
+    arrancan y el escaneo sigue en serie.
+
+    Los avisos del escaneo salen por `log`; mientras haya una barra de progreso
+    activa conviene pasar algo como tqdm.write para no romperla.
+    """
     if extensions is None:
         extensions = [".cs", ".js", ".ts", ".tsx", ".html", ".cshtml"]
 
-    all_findings = []
+    paths = _walk(root_path, extensions, log)
+    # Alcanza con mirar los primeros archivos para decidir si conviene el pool
+    head = list(islice(paths, PARALLEL_MIN_FILES))
+    remaining = chain(head, paths)
+    workers = os.cpu_count() or 1
     scanned = 0
+    found = 0
 
-    for dirpath, dirnames, filenames in os.walk(root_path):
-        # Ignorar directorios comunes no relevantes
-        dirnames[:] = [
-            d for d in dirnames
-            if d not in {"bin", "obj", "node_modules", ".git", ".vs", "packages", "debug", "release"}
-        ]
+    if workers >= 2 and len(head) >= PARALLEL_MIN_FILES:
+        remaining = list(remaining)
+        try:
+            # spawn: este generador suele correr en un thread del analyzer y hacer
+            # fork de un proceso con threads activos puede dejar locks tomados
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                results = executor.map(scan_file, remaining, chunksize=PARALLEL_CHUNKSIZE)
+                try:
+                    for findings in results:
+                        scanned += 1
+                        found += len(findings)
+                        yield from findings
+                finally:
+                    # Si se deja de consumir (generador cerrado), cancela los archivos
+                    # pendientes antes de que el `with` espere a que el pool termine
+                    results.close()
+            remaining = []
+        except BrokenProcessPool as e:
+            log(f"[Scanner] Pool de procesos no disponible ({e}): se sigue en serie")
+            remaining = remaining[scanned:]
 
-        for filename in filenames:
-            ext = os.path.splitext(filename)[1].lower()
-            if ext not in extensions:
-                continue
+    # En serie el recorrido también es perezoso: se escanea mientras se camina
+    for findings in map(scan_file, remaining):
+        scanned += 1
+        found += len(findings)
+        yield from findings
 
-            file_path = os.path.join(dirpath, filename)
-            findings = scan_file(file_path)
-            all_findings.extend(findings)
-            scanned += 1
+    log(f"[Scanner] Archivos escaneados: {scanned}, hallazgos: {found}")
 
-    print(f"[Scanner] Archivos escaneados: {scanned}, hallazgos: {len(all_findings)}")
-    return all_findings
+
+def scan_directory(root_path: str, extensions: List[str] = None) -> List[Finding]:
+    """Escanea recursivamente un directorio buscando patrones peligrosos."""
+    return list(iter_findings(root_path, extensions))